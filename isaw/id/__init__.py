@@ -23,34 +23,102 @@ Manage unique ids for ISAW entities
 Defines the class Maker(), which provides all functionality of the package.
 """
 
+from binascii import unhexlify
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import logging
 from datetime import datetime
 from hashlib import blake2b
-from os import makedirs
-from os.path import abspath, isdir, join, realpath
-import sys
+from itertools import repeat
+from os import SEEK_END, makedirs, replace, stat
+from os.path import join
 from shutil import copy2, rmtree
+from stat import S_ISDIR
+from warnings import warn
 
 
 DEFAULT_ID_LENGTH = 3
 DEFAULT_NAMESPACE = ''
 MAX_TRIES = 10
+STAMP_CACHE_SIZE = 8
+
+logger = logging.getLogger(__name__)
+_hashers = {}
+
+
+def _now_stamp():
+    """Return the ISO stamp bytes for the current local time."""
+    return datetime.now().isoformat().encode('ascii')
+
+
+def _content_bytes(content):
+    """Convert content passed to make() into the bytes to be hashed."""
+    if isinstance(content, str):
+        return content.encode('utf-8')
+    if isinstance(content, (bytes, bytearray)):
+        return content
+    return bytes(content)
+
+
+def _prefix(ns):
+    """Return the string that precedes the digest in ids for namespace ns."""
+    return f'/{ns}/' if ns else '/'
+
+
+def _hash(stamp, data, digest_size):
+    """Return the raw BLAKE2b digest of stamp followed by data."""
+    # copying an initialized hasher skips the parameter block setup
+    try:
+        h = _hashers[digest_size].copy()
+    except KeyError:
+        _hashers[digest_size] = blake2b(digest_size=digest_size)
+        h = _hashers[digest_size].copy()
+    h.update(stamp)
+    h.update(data)
+    return h.digest()
+
+
+def _hash_chunk(stamp, contents, digest_size):
+    """Return the hex digests for a list of contents.
+
+    All contents share stamp, or each is stamped with the current time as it
+    is hashed when stamp is None.
+    """
+    if stamp is None:
+        return [
+            _hash(_now_stamp(), _content_bytes(c), digest_size).hex()
+            for c in contents]
+    return [
+        _hash(stamp, _content_bytes(c), digest_size).hex() for c in contents]
+
+
+def _hash_parallel(stamp, data, digest_size, processes):
+    """Return the hex digests for a list of bytes, hashed by a process pool."""
+    size = -(-len(data) // processes)
+    chunks = [data[i:i + size] for i in range(0, len(data), size)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(
+            _hash_chunk, repeat(stamp), chunks, repeat(digest_size))
+        return [d for chunk in results for d in chunk]
+
 
 class Maker:
     """Make unique IDs for ISAW entities, optionally within a namespace.
 
     Public methods:
     make() -- creates an ID based on content bytes and datetime stamp
+    make_many() -- creates a list of IDs, one for each of a series of contents
+    close() -- writes new IDs back to the registry files
 
     Default behavior is to create unique IDs using the BLAKE2 cryptographic
     hash functions, providing as input a series of content bytes and a
     datetime stamp in ISO format and checking the result for uniqueness within
     an arbitrary namespace as documented by a registry file. Registry file
     contents (text files with one hash hexdigest per line) are loaded on
-    demand, but persist in memory until the maker instance that loaded them
-    is destroyed. On destruction, the instance attempts to write back to file
-    any ids added to loaded registries after create a .bak file of the prior
-    version.
+    demand and held in memory as raw digest bytes until the maker instance
+    that loaded them is closed. On close(), or on leaving a with block, the
+    instance attempts to write back to file any ids added to loaded
+    registries after create a .bak file of the prior version.
     """
 
     def __init__(
@@ -75,47 +143,92 @@ class Maker:
                 raise ValueError(
                     'Maker initialized with ensure_unique=True but no '
                     'registry_path was provided.')
-            path = abspath(realpath(registry_path))
-            if isdir(path):
+            try:
+                is_dir = S_ISDIR(stat(registry_path).st_mode)
+            except FileNotFoundError:
+                is_dir = False
+            if is_dir:
                 self.registry_path=registry_path
                 self.registry = {}
-                self.dirty = {}
+                self.added = {}
             else:
                 raise IOError(
                     'Make initialized with registry_path="{}", but it is '
-                    'not a directory.')
+                    'not a directory.'.format(registry_path))
         self.namespace = namespace
+        self._prefix = _prefix(namespace)
         self.id_length = id_length
+        self._stamp_cache = OrderedDict()
+
 
+    def __enter__(self):
+        """Return the instance for use in a with statement."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the instance on leaving a with statement."""
+        self.close()
 
     def __del__(self):
         """Teardown a Maker instance.
 
-        If the instance was instantiated with ensure_unique=True, attempt to
-        write any new values to file.
+        Registries are written back by close(). If the instance is garbage
+        collected with unsaved ids, emit a ResourceWarning and close it.
+        """
+
+        if getattr(self, 'registry', None):
+            if any(self.added.values()):
+                warn(
+                    'Maker with unsaved ids was not closed', ResourceWarning,
+                    source=self)
+            self.close()
+
+    def close(self):
+        """Write new ids back to their registry files.
+
+        If the instance was instantiated with ensure_unique=True, append any
+        new values to the loaded registry files and remove the temporary
+        copies made on load. Before appending, each registry's load-time copy
+        is moved to a timestamped .bak file, so the .bak holds the registry
+        as it was when this instance loaded it, not as it was at close time
+        (if that copy is missing, the registry file is copied instead).
+        Loaded registries are released, so they are read again if the
+        instance is used after closing.
         """
 
         if self.ensure:
-            for k, v in self.registry.items():
-                try:
-                    dirty = self.dirty[k]
-                except KeyError:
-                    pass
-                else:
-                    if dirty:
-                        path = join(self.registry_path, k)
-                        stamp = datetime.now().isoformat()
-                        copy2(path, '{}.{}.bak'.format(path, stamp))
-                        with open(path, 'w') as f:
-                            f.write('\n'.join(list(v)))
+            for k, added in self.added.items():
+                if added:
+                    path = join(self.registry_path, k)
+                    stamp = datetime.now().isoformat()
+                    bak = '{}.{}.bak'.format(path, stamp)
+                    # the copy stashed in tmp on load is the prior version:
+                    # keep it by renaming it, then append just the new ids;
+                    # another maker closing on the same directory may have
+                    # removed tmp already, so fall back to copying the file
+                    try:
+                        replace(join(self.registry_path, 'tmp', k), bak)
+                    except FileNotFoundError:
+                        copy2(path, bak)
+                    with open(path, 'ab+') as f:
+                        lead = b''
+                        if f.tell() > 0:
+                            f.seek(-1, SEEK_END)
+                            if f.read(1) != b'\n':
+                                lead = b'\n'
+                        f.write(
+                            lead + '\n'.join(d.hex() for d in added).encode(
+                                'ascii'))
             if len(self.registry) > 0:
-                rmtree(join(self.registry_path, 'tmp'))
+                rmtree(join(self.registry_path, 'tmp'), ignore_errors=True)
+            self.registry = {}
+            self.added = {}
 
     def make(
         self,
         content,
         namespace=None,
-        date_time=datetime.now(),
+        date_time=None,
         id_length=None):
         """Generate an id.
 
@@ -123,61 +236,124 @@ class Maker:
         content -- zero or more bytes of content to give to the hash function
         namespace -- optional string to use for namespace in ID generation
         date_time -- a datetime object that is converted to an isoformat stamp
-                     and appended to the content before hash generation
+                     and prepended to the content before hash generation
+                     (defaults to the time of the call)
         id_length -- optional number of hex values to use in the id
 
         This method creates ID strings like '/46ee55' when namespace == '' and
         '/foo/8c2dcb' when namespace == 'foo'.
         """
 
-        stamp = bytes(date_time.isoformat(), encoding='ascii')
-        if type(content) == str:
-            data = content.encode('utf-8')
+        stamp = self._stamp(date_time)
+        data = _content_bytes(content)
+        if id_length is not None:
+            length = id_length
+        else:
+            length = self.id_length
+        if namespace is None:
+            ns, prefix = self.namespace, self._prefix
+        else:
+            ns, prefix = namespace, _prefix(namespace)
+        if not self.ensure:
+            return prefix + _hash(stamp, data, length).hex()
+        return self._make_unique(ns, prefix, stamp, data, length)
+
+    def make_many(
+        self,
+        contents,
+        namespace=None,
+        date_time=None,
+        id_length=None,
+        processes=None):
+        """Generate a list of ids, one for each item in contents.
+
+        Keyword arguments are as for make(), plus:
+        processes -- optional number of worker processes to hash contents
+                     with when ensure_unique=False (ignored if less than 2)
+
+        The namespace and id length are resolved once for the whole batch.
+        An explicit date_time is shared by every item; without one, each item
+        is stamped with the time it is hashed, as make() would do in a loop.
+        Contents are converted to bytes before
+        being sent to worker processes. Callers using processes on platforms
+        that spawn workers must guard their entry point with
+        if __name__ == '__main__'.
+        """
+
+        if date_time is None:
+            stamp = None
         else:
-            data = bytes(content)
-        data = stamp + data
+            stamp = self._stamp(date_time)
         if id_length is not None:
             length = id_length
         else:
             length = self.id_length
-        h = blake2b(data, digest_size=length)
-        digest = h.hexdigest()
         if namespace is None:
-            ns = self.namespace
+            ns, prefix = self.namespace, self._prefix
         else:
-            ns = namespace
-        if self.ensure:
-            tries = 0
-            while not self._unique(ns, digest):
-                if tries == 0:
-                    logger = logging.getLogger(sys._getframe().f_code.co_name)
+            ns, prefix = namespace, _prefix(namespace)
+        if not self.ensure:
+            if processes is not None and processes >= 2:
+                data = [_content_bytes(c) for c in contents]
+                digests = _hash_parallel(stamp, data, length, processes)
+            else:
+                digests = _hash_chunk(stamp, contents, length)
+            return [prefix + d for d in digests]
+        make_unique = self._make_unique
+        if stamp is None:
+            return [
+                make_unique(
+                    ns, prefix, _now_stamp(), _content_bytes(c), length)
+                for c in contents]
+        return [
+            make_unique(ns, prefix, stamp, _content_bytes(c), length)
+            for c in contents]
+
+
+    def _make_unique(self, ns, prefix, stamp, data, length):
+        """Hash stamp and data into an id unique in ns and register it."""
+        # digest_size is part of the BLAKE2b parameter block, so each
+        # longer candidate is a fresh hash; only compute one on collision
+        r = self._load_register(ns)
+        for length in range(length, length + MAX_TRIES + 1):
+            digest = _hash(stamp, data, length)
+            if digest not in r:
+                break
+            if logger.isEnabledFor(logging.WARNING):
                 logger.warning(
-                    'hash collision with "{}"'.format(digest))
-                if tries >= MAX_TRIES:
-                    raise ValueError(
-                        'Could not find unique hash after {} tries.'
-                        ''.format(tries))
-                length += 1
-                h = blake2b(data, digest_size=length)
-                digest = h.hexdigest()
-                tries += 1
-            self._register(ns, digest)
-        if ns != '':
-            return '/{}/{}'.format(ns, digest)
+                    'hash collision with "{}"'.format(digest.hex()))
         else:
-            return '/{}'.format(digest)
+            raise ValueError(
+                'Could not find unique hash after {} tries.'
+                ''.format(MAX_TRIES))
+        self._register(ns, digest)
+        return prefix + digest.hex()
 
 
-    def _unique(self, ns, digest):
-        """Test if digest is in a namespace registry."""
-        r = self._load_register(ns)
-        return not(digest in r)
+    def _stamp(self, date_time):
+        """Return the ISO stamp bytes for date_time, caching recent ones."""
+        if date_time is None:
+            return _now_stamp()
+        # keyed on identity; each entry holds its datetime so the id can't be
+        # reused by another object while it is cached
+        cache = self._stamp_cache
+        key = id(date_time)
+        try:
+            stamp = cache[key][1]
+        except KeyError:
+            stamp = date_time.isoformat().encode('ascii')
+            cache[key] = (date_time, stamp)
+            if len(cache) > STAMP_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return stamp
 
 
     def _register(self, ns, digest):
-        """Add a new digest to a namespace registry."""
+        """Add a new raw digest to a namespace registry."""
         self.registry[ns].add(digest)
-        self.dirty[ns] = True
+        self.added.setdefault(ns, []).append(digest)
 
 
     def _load_register(self, ns):
@@ -194,15 +370,15 @@ class Maker:
 
             # read the file
             try:
-                f = open(path, 'r')
+                f = open(path, 'rb')
             except IOError as e:
                 raise IOError(
                     'Failed to open register {} from file "{}"'
                     ''.format(ns, path)
                     ).with_traceback(e.__traceback__)
             else:
-                r = set(f.read().splitlines())
-                logger = logging.getLogger(sys._getframe().f_code.co_name)
+                with f:
+                    r = set(map(unhexlify, f.read().split()))
                 logger.info(
                     'Read {} ids from register file "{}"'
                     ''.format(len(r), path))
@@ -21,13 +21,15 @@
 Test basic functionality of the isaw.id package
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import gc
 import glob
 import isaw.id
 from nose.tools import assert_equal, assert_raises, assert_true
 from os import remove
 from os.path import dirname, isfile, join
 import shutil
+import warnings
 
 
 WHEN = datetime(2017, 10, 21, 6, 47, 18, 153304)
@@ -93,17 +95,116 @@ def test_make_length_default():
     assert_equal(len(this), 17*2+1)
     assert_equal(this, '/c73b80d0146d6d03679c3077f9f05129db')
 
+def test_make_date_time_default():
+    global WHEN
+    times = [WHEN, WHEN.replace(second=19)]
+
+    class FakeDateTime:
+        @staticmethod
+        def now():
+            return times.pop(0)
+
+    m = isaw.id.Maker(
+        ensure_unique=False)
+    expected = [m.make(content='', date_time=t) for t in times]
+    real = isaw.id.datetime
+    isaw.id.datetime = FakeDateTime
+    try:
+        this = m.make(content='')
+        that = m.make(content='')
+    finally:
+        isaw.id.datetime = real
+    assert_equal([this, that], expected)
+    assert_true(this != that)
+
+def test_make_many():
+    global WHEN
+    m = isaw.id.Maker(
+        ensure_unique=False,
+        namespace='bar')
+    these = m.make_many(contents=['', 'foo'], date_time=WHEN)
+    assert_equal(these, ['/bar/8c2dcb', '/bar/46ee55'])
+
+def test_make_many_ensure():
+    global WHEN
+    path = join(dirname(__file__), 'data')
+    src = join(path, 'nstest')
+    dest = join(path, 'temptest')
+    shutil.copy(src, dest)
+    # 'foo' collides with the registry; with the shared explicit stamp the
+    # second 'cat' collides with the first, just as in a make() loop
+    contents = ['foo', 'cat', 'cat']
+    with isaw.id.Maker(registry_path=path, namespace='temptest') as m:
+        these = m.make_many(contents=contents, date_time=WHEN)
+    assert_equal(these[0], '/temptest/ee950528')
+    assert_equal(len(set(these)), len(contents))
+    with open(dest, 'r') as f:
+        results = f.read().splitlines()
+    assert_equal(results, ['46ee55'] + [t.split('/')[-1] for t in these])
+    shutil.copy(src, dest)
+    with isaw.id.Maker(registry_path=path, namespace='temptest') as m:
+        those = [m.make(content=c, date_time=WHEN) for c in contents]
+    assert_equal(these, those)
+    remove(dest)
+    for fn in glob.glob(join(path, '*.bak')):
+        remove(fn)
+
+def test_make_many_date_time_default():
+    global WHEN
+    path = join(dirname(__file__), 'data')
+    src = join(path, 'nstest')
+    dest = join(path, 'temptest')
+    shutil.copy(src, dest)
+    contents = ['x'] * (isaw.id.MAX_TRIES + 2)
+    times = [WHEN + timedelta(microseconds=i) for i in range(len(contents))]
+    m = isaw.id.Maker(
+        ensure_unique=False,
+        namespace='temptest')
+    expected = [
+        m.make(content=c, date_time=t) for c, t in zip(contents, times)]
+
+    class FakeDateTime:
+        @staticmethod
+        def now():
+            return next(now)
+
+    real = isaw.id.datetime
+    isaw.id.datetime = FakeDateTime
+    try:
+        now = iter(times)
+        these = m.make_many(contents=contents)
+        with isaw.id.Maker(registry_path=path, namespace='temptest') as n:
+            now = iter(times)
+            those = n.make_many(contents=contents)
+            isaw.id.datetime = real
+    finally:
+        isaw.id.datetime = real
+    # each item gets the time it was hashed, as in a make() loop
+    assert_equal(these, expected)
+    assert_equal(those, expected)
+    remove(dest)
+    for fn in glob.glob(join(path, '*.bak')):
+        remove(fn)
+
+def test_make_many_parallel():
+    global WHEN
+    m = isaw.id.Maker(
+        ensure_unique=False)
+    contents = [memoryview(str(i).encode('utf-8')) for i in range(100)]
+    serial = m.make_many(contents=contents, date_time=WHEN)
+    parallel = m.make_many(contents=contents, date_time=WHEN, processes=2)
+    assert_equal(parallel, serial)
+
 def test_make_namespace_ensure():
     global WHEN
     path = join(dirname(__file__), 'data')
     src = join(path, 'nstest')
     dest = join(path, 'temptest')
     shutil.copy(src, dest)
-    m = isaw.id.Maker(registry_path=path)
-    this = m.make(content='foo', namespace='temptest', date_time=WHEN)
+    with isaw.id.Maker(registry_path=path) as m:
+        this = m.make(content='foo', namespace='temptest', date_time=WHEN)
     # expect a collision, so algorithm adds a hex digit to the digest
     assert_equal(this, '/temptest/ee950528')
-    del(m)
     remove(dest)
     for fn in glob.glob(join(path, '*.bak')):
         remove(fn)
@@ -115,6 +216,10 @@ def test_bad_register():
     assert_raises(IOError,
         m.make, content='foo', namespace='bogus', date_time=WHEN)
 
+def test_bad_registry_path():
+    path = join(dirname(__file__), 'data', 'nstest')
+    assert_raises(IOError, isaw.id.Maker, registry_path=path)
+
 def test_saved():
     global WHEN
     path = join(dirname(__file__), 'data')
@@ -122,10 +227,9 @@ def test_saved():
     dest = join(path, 'temptest')
     shutil.copy(src, dest)
     contents = 'The cat in the hat'.split()
-    m = isaw.id.Maker(registry_path=path, namespace='temptest')
-    for c in contents:
-        m.make(content=c, date_time=WHEN)
-    del(m)
+    with isaw.id.Maker(registry_path=path, namespace='temptest') as m:
+        for c in contents:
+            m.make(content=c, date_time=WHEN)
     with open(dest, 'r') as f:
         results = f.read().splitlines()
     assert_equal(len(contents), len(results)-1)
@@ -133,6 +237,70 @@ def test_saved():
     for fn in glob.glob(join(path, '*.bak')):
         remove(fn)
 
+def test_saved_bak():
+    global WHEN
+    path = join(dirname(__file__), 'data')
+    src = join(path, 'nstest')
+    dest = join(path, 'temptest')
+    shutil.copy(src, dest)
+    with isaw.id.Maker(registry_path=path, namespace='temptest') as m:
+        this = m.make(content='hat', date_time=WHEN)
+    baks = glob.glob(join(path, 'temptest.*.bak'))
+    assert_equal(len(baks), 1)
+    with open(src, 'r') as f:
+        original = f.read()
+    with open(baks[0], 'r') as f:
+        assert_equal(f.read(), original)
+    with open(dest, 'r') as f:
+        results = f.read().splitlines()
+    assert_equal(results, original.splitlines() + [this.split('/')[-1]])
+    remove(dest)
+    for fn in baks:
+        remove(fn)
+
+def test_saved_del():
+    global WHEN
+    path = join(dirname(__file__), 'data')
+    src = join(path, 'nstest')
+    dest = join(path, 'temptest')
+    shutil.copy(src, dest)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        m = isaw.id.Maker(registry_path=path, namespace='temptest')
+        this = m.make(content='cat', date_time=WHEN)
+        del(m)
+        gc.collect()
+    assert_true(
+        any(issubclass(w.category, ResourceWarning) for w in caught))
+    with open(dest, 'r') as f:
+        results = f.read().splitlines()
+    assert_equal(results, ['46ee55', this.split('/')[-1]])
+    remove(dest)
+    for fn in glob.glob(join(path, '*.bak')):
+        remove(fn)
+
+def test_saved_shared_path():
+    global WHEN
+    path = join(dirname(__file__), 'data')
+    src = join(path, 'nstest')
+    dest = join(path, 'temptest')
+    shutil.copy(src, dest)
+    a = isaw.id.Maker(registry_path=path, namespace='temptest')
+    b = isaw.id.Maker(registry_path=path, namespace='temptest')
+    this = a.make(content='cat', date_time=WHEN)
+    that = b.make(content='hat', date_time=WHEN)
+    # a removes the tmp directory holding b's copy of the registry too
+    a.close()
+    b.close()
+    with open(dest, 'r') as f:
+        results = f.read().splitlines()
+    assert_equal(
+        results, ['46ee55', this.split('/')[-1], that.split('/')[-1]])
+    assert_equal(len(glob.glob(join(path, 'temptest.*.bak'))), 2)
+    remove(dest)
+    for fn in glob.glob(join(path, '*.bak')):
+        remove(fn)
+
 def test_saved_tmp():
     global WHEN
     path = join(dirname(__file__), 'data')
@@ -140,11 +308,11 @@ def test_saved_tmp():
     dest = join(path, 'temptest')
     shutil.copy(src, dest)
     contents = 'Do you like my hat'.split()
-    m = isaw.id.Maker(registry_path=path, namespace='temptest')
-    for c in contents:
-        m.make(content=c, date_time=WHEN)
-    assert_true(isfile(join(path, 'tmp', 'temptest')))
-    del(m)
+    with isaw.id.Maker(registry_path=path, namespace='temptest') as m:
+        for c in contents:
+            m.make(content=c, date_time=WHEN)
+        assert_true(isfile(join(path, 'tmp', 'temptest')))
+    assert_true(not isfile(join(path, 'tmp', 'temptest')))
     remove(dest)
     for fn in glob.glob(join(path, '*.bak')):
         remove(fn)